@@ -14,13 +14,23 @@ https://learn.adafruit.com/thermocouple/f-dot-a-q
 
 import os
 import sys
+import math
 import datetime
 from sys import stderr
-from collections import OrderedDict
-from math import exp
 import time
-import subprocess
+import signal
+import threading
+try:
+    import queue
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python2.7
+    import Queue as queue
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
+import Adafruit_GPIO.GPIO as GPIO
 import Adafruit_GPIO.SPI as SPI
 import Adafruit_MAX31855.MAX31855 as MAX31855
 
@@ -32,30 +42,42 @@ DO  = 25
 CS  = [23, 18, 22, 17]
 SENSOR_NAMES = ['Firebox', 'Cat', 'Stove Top', 'Flue']
 
+# Browser refresh period of the web page, in seconds
+WEB_REFRESH = 1
+
+# Format of the timestamp column in the log files
+TIMESTAMP_FORMAT = '%H:%M:%S'
+
+# Log files are block buffered and flushed periodically by the LogWriter
+OUTPUT_BUFFER_SIZE = 65536
+
 
 def c_to_f(c):
     '''Convert Celcius temperature to Farenheit.
     '''
-    return c * 9.0 / 5.0 + 32.0
+    return c * 1.8 + 32.0
 
 
-def get_output_file(filename, data_dict, sep):
+def get_output_file(filename, header_line):
     """Create or open the output file.
 
     If a new file is being created, add a header line.
     """
-    header_line = sep.join(data_dict.keys())
+    header = header_line + '\n'
     x = 1
     while True:
         # Loop will break at a return statement
-        if os.path.exists(filename) and not os.stat(filename).st_size == 0:
+        # One open serves both to check the header and to append
+        f = open(filename, 'a+', OUTPUT_BUFFER_SIZE)
+        if os.fstat(f.fileno()).st_size != 0:
             # Check for a header line
-            f_check = open(filename)
-            if f_check.readline().strip() == header_line:
+            f.seek(0)
+            if f.read(len(header)) == header:
                 # Headers match, we're good to go
-                f_check.close()
-                return open(filename, 'a', 1) # line buffered
+                f.seek(0, os.SEEK_END)
+                return f
             else:
+                f.close()
                 stderr.write('File %s has unexpected header line\n' % filename)
                 x += 1
                 if x == 2:
@@ -64,120 +86,270 @@ def get_output_file(filename, data_dict, sep):
                 filename = base + '-' + str(x) + extension
                 # The next loop will try with this new filename
         else:
-            # Is safe to overwrite an empty file
-            f = open(filename, 'w', 1)  # line buffered
-            f.write(header_line + '\n')
+            # Is safe to write to an empty file
+            f.write(header)
             return f
 
 
+def handle_sigterm(signum, frame):
+    '''Treat a kill like ctrl-c, so that main() flushes the logs before exiting.
+    '''
+    raise KeyboardInterrupt
+
+
+def flush_output_file(f):
+    """Push any buffered log lines all the way to disk.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def write_web_file(filename, html):
+    """Replace the web output file atomically.
+
+    The html is written to a temporary file which is then renamed over the
+    old one, so the web server never serves a partially written page.
+    """
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as web_file:
+        web_file.write(html)
+    os.rename(tmp_filename, filename)
+
+
+class LogWriter(threading.Thread):
+    """Write the log files and web page from a background thread.
+
+    The sampling loop only queues work here, so a slow write to the SD card
+    cannot delay the next sensor read.
+    """
+
+    def __init__(self, web_output_file, flush_interval):
+        '''Flush_interval is in seconds.
+        '''
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.web_output_file = web_output_file
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=1024)
+        self.logs = {} # log name -> (requested filename, open file)
+
+    def _put(self, item):
+        if not self.is_alive():
+            raise RuntimeError('Log writer thread has stopped')
+        self.queue.put(item)
+
+    def write_web(self, html):
+        """Queue a new version of the web page.
+        """
+        self._put(('web', html))
+
+    def write_row(self, log, filename, header_line, line):
+        """Queue a line for the named log.
+
+        A change of filename, such as at midnight, starts a new file.
+        """
+        self._put(('row', (log, filename, header_line, line)))
+
+    def stop(self):
+        """Write out everything queued so far, then close the log files.
+        """
+        # Nothing would ever take the sentinel off the queue of a dead thread
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+    def run(self):
+        last_flush_time = time.time()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, payload = item
+            if kind == 'web':
+                write_web_file(self.web_output_file, payload)
+            else:
+                log, filename, header_line, line = payload
+                if log not in self.logs or self.logs[log][0] != filename:
+                    if log in self.logs:
+                        self.logs[log][1].close()
+                    print('Opening new %s output file' % log)
+                    self.logs[log] = (filename, get_output_file(filename, header_line))
+                self.logs[log][1].write(line)
+            # Periodically push buffered log lines to disk
+            if time.time() - last_flush_time >= self.flush_interval:
+                for _, f in self.logs.values():
+                    flush_output_file(f)
+                last_flush_time = time.time()
+        # Cleanup
+        for _, f in self.logs.values():
+            flush_output_file(f)
+            f.close()
+
+
+class WebPageHandler(BaseHTTPRequestHandler):
+    """Serve the current temperatures page, and nothing else.
+    """
+
+    def do_GET(self):
+        web_output_file = self.server.web_output_file
+        if self.path.split('?')[0] not in ('/', '/' + os.path.basename(web_output_file)):
+            self.send_error(404)
+            return
+        try:
+            with open(web_output_file, 'rb') as web_file:
+                html = web_file.read()
+        except IOError:
+            # The first page has not been written yet
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(html)))
+        self.end_headers()
+        self.wfile.write(html)
+
+
+class WebServer(ThreadingMixIn, HTTPServer):
+    """Web server for the current temperatures page, run on a background thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, web_output_file):
+        HTTPServer.__init__(self, ('', port), WebPageHandler)
+        self.web_output_file = web_output_file
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 def main(web_output_file, interval, web_server_port, verbose,
-         log_interval, output_file_pattern, output_separator,
+         log_interval, output_file_pattern, output_separator, flush_interval,
          log_short_interval, short_interval, short_output_file_pattern):
-    '''Interval is in minutes. Short_interval is seconds.
+    '''Log_interval and flush_interval are in minutes. Short_interval is seconds.
     '''
 
     # Hardware configuration is set at top of file
     global CLK, DO, CS
 
     # Setup
-    output_file = None
+    signal.signal(signal.SIGTERM, handle_sigterm)
     log_interval = datetime.timedelta(minutes=log_interval)
     file_start_time = None # For logging hours since start of file
     interval_start_time = None
-    web_server = subprocess.Popen(['python', '-m', 'SimpleHTTPServer', str(web_server_port)], cwd=os.path.dirname(web_output_file))
+    writer = LogWriter(web_output_file, flush_interval * 60)
+    writer.start()
+    web_server = WebServer(web_server_port, web_output_file)
+
+    # The log columns never change, so build the header and row formats once
+    sep = output_separator.replace('%', '%%')
+    header_names = ['timestamp', 'hours'] + ['%s F' % name for name in SENSOR_NAMES]
+    header_line = output_separator.join(header_names + ['internal %s F' % name for name in SENSOR_NAMES])
+    row_format = sep.join(['%s', '%06.3f'] + ['%.2f'] * (2 * len(SENSOR_NAMES))) + '\n'
 
     if log_short_interval:
-	    short_output_file = None
-	    short_interval = datetime.timedelta(seconds=short_interval)
-	    short_file_start_time = None # For logging hours since start of file
-	    short_interval_start_time = None
+        short_interval = datetime.timedelta(seconds=short_interval)
+        short_file_start_time = None # For logging hours since start of file
+        short_interval_start_time = None
+        short_header_line = output_separator.join(header_names)
+        short_row_format = sep.join(['%s', '%07.4f'] + ['%.2f'] * len(SENSOR_NAMES)) + '\n'
+
+    verbose_format = '%s ' + '; '.join(['%.2f,%.2f,%.2f'] * len(CS))
+
+    # The web page layout is fixed too
+    html_lines = ['%s: %%.1f F' % name for name in SENSOR_NAMES] + ['<br>', '<br>']
+    html_lines += ['%s: %%.1f internal; errors: %%s' % name for name in SENSOR_NAMES]
+    html_format = ('<html><head><meta http-equiv="refresh" content="%i"><title>Current Temps</title></head>' % WEB_REFRESH +
+                   '<body><h1>' + '<br>'.join(html_lines) + '<br><<%s></h1></body></html>')
+    # No point rewriting the page faster than the browser reloads it
+    # (round up, so the page is never written more than once per refresh)
+    web_every = max(1, int(math.ceil(WEB_REFRESH / float(interval))))
+    n_samples = 0
 
     print('About to connect to %i sensors' % len(CS))
-    sensors = [MAX31855.MAX31855(CLK, this_CS, DO) for this_CS in CS]
+    # The sensors share one GPIO handle rather than each detecting the platform
+    gpio = GPIO.get_platform_gpio()
+    sensors = [MAX31855.MAX31855(CLK, this_CS, DO, gpio=gpio) for this_CS in CS]
     print('Sensors connected')
-    while True:
-        try:
-            # Collect the data
-            temps = [sensor.readAll() for sensor in sensors]
-            for t in temps:
-                for k in t.keys():
-                    if k != 'state':
-                        t[k] = c_to_f(t[k])
-            now = datetime.datetime.now()
-
-            # Stdout output
-            if verbose:
-                print(now.isoformat() + ' ' + '; '.join(['%.2f,%.2f,%.2f' % (t['temp'], t['internal'], t['linearized']) for t in temps]))
-
-            # Html output
-            # Always overwrite current file
-            html = '<html><head><meta http-equiv="refresh" content="1"><title>Current Temps</title></head>'
-            lines = ['%s: %.1f F' % (name, t['linearized']) for name, t in zip(SENSOR_NAMES, temps)]
-            lines += ['<br>', '<br>']
-            lines += ['%s: %.1f internal; errors: %s' % (name, t['internal'], str([s for s, v in t['state'].items() if v])) for name, t in zip(SENSOR_NAMES, temps)]
-            html += '<body><h1>%s<br><<%s></h1></body></html>' % ('<br>'.join(lines), now.isoformat())
-            with open(web_output_file, 'w') as web_file:
-                web_file.write(html)
-
-            # Log file output
-            if not interval_start_time:
-                interval_start_time = now
-            if log_short_interval:
-                if not short_interval_start_time:
-                    short_interval_start_time = now
-
-            if (not file_start_time) or (now - interval_start_time >= log_interval):
-                if not file_start_time:
-                    file_start_time = now
-                # Assemble data dictionary
-                data_dict = OrderedDict([('timestamp', now.strftime('%H:%M:%S')), ('hours', format((now-file_start_time).total_seconds()/3600.0, '06.3f'))])
-                data_dict.update([('%s F' % name, format(t['linearized'], '.2f')) for name, t in zip(SENSOR_NAMES, temps)])
-                data_dict.update([('internal %s F' % name, format(t['internal'], '.2f')) for name, t in zip(SENSOR_NAMES, temps)])
-                # Write out the data
-                if not output_file or now.date() != current_date:
-                    if output_file:
-                        output_file.close()
-                    print('Opening new output file')
-                    current_date = datetime.datetime.now().date()
-                    output_file = get_output_file(current_date.strftime(output_file_pattern), data_dict, output_separator)
-                output_file.write(output_separator.join([str(x) for x in data_dict.values()]) + '\n')
-                interval_start_time = now
-
-            if log_short_interval:
-                if (not short_file_start_time) or (now - short_interval_start_time >=short_interval):
-                    if not short_file_start_time:
-                        short_file_start_time = now
-                    # Assemble data dictionary
-                    data_dict = OrderedDict([('timestamp', now.strftime('%H:%M:%S')), ('hours', format((now-short_file_start_time).total_seconds()/3600.0, '07.4f'))])
-                    data_dict.update([('%s F' % name, format(t['linearized'], '.2f')) for name, t in zip(SENSOR_NAMES, temps)])
+    try:
+        while True:
+            try:
+                # Collect the data, one list per field in sensor order
+                temps = [sensor.readAll() for sensor in sensors]
+                linearized = [c_to_f(t['linearized']) for t in temps]
+                internal = [c_to_f(t['internal']) for t in temps]
+                now = datetime.datetime.now()
+
+                # Stdout output
+                if verbose:
+                    values = (now.isoformat(),)
+                    for raw_f, internal_f, linearized_f in zip([c_to_f(t['temp']) for t in temps], internal, linearized):
+                        values += (raw_f, internal_f, linearized_f)
+                    print(verbose_format % values)
+
+                # Html output
+                # Overwrite the current file at most once per browser refresh
+                if n_samples % web_every == 0:
+                    values = list(linearized)
+                    for internal_f, t in zip(internal, temps):
+                        values += [internal_f, str([s for s, v in t['state'].items() if v])]
+                    values.append(now.isoformat())
+                    writer.write_web(html_format % tuple(values))
+                n_samples += 1
+
+                # Log file output
+                if not interval_start_time:
+                    interval_start_time = now
+                if log_short_interval:
+                    if not short_interval_start_time:
+                        short_interval_start_time = now
+
+                if (not file_start_time) or (now - interval_start_time >= log_interval):
+                    if not file_start_time:
+                        file_start_time = now
+                    # Assemble the row
+                    row = (now.strftime(TIMESTAMP_FORMAT), (now-file_start_time).total_seconds()/3600.0)
+                    row += tuple(linearized) + tuple(internal)
                     # Write out the data
-                    if not short_output_file or now.date() != current_date:
-                        if short_output_file:
-                            short_output_file.close()
-                        print('Opening new short output file')
-                        current_date = datetime.datetime.now().date()
-                        short_output_file = get_output_file(current_date.strftime(short_log_file_pattern), data_dict, output_separator)
-                    short_output_file.write(output_separator.join([str(x) for x in data_dict.values()]) + '\n')
-                    short_interval_start_time = now
+                    writer.write_row('long', now.strftime(output_file_pattern), header_line, row_format % row)
+                    interval_start_time = now
 
-            time.sleep(interval - time.time() % interval) # corrects for drift
+                if log_short_interval:
+                    if (not short_file_start_time) or (now - short_interval_start_time >=short_interval):
+                        if not short_file_start_time:
+                            short_file_start_time = now
+                        # Assemble the row
+                        row = (now.strftime(TIMESTAMP_FORMAT), (now-short_file_start_time).total_seconds()/3600.0)
+                        row += tuple(linearized)
+                        # Write out the data
+                        writer.write_row('short', now.strftime(short_output_file_pattern), short_header_line, short_row_format % row)
+                        short_interval_start_time = now
 
-        except KeyboardInterrupt:
-            break
+                time.sleep(interval - time.time() % interval) # corrects for drift
 
-    web_server.terminate() # Cleanup
+            except KeyboardInterrupt:
+                break
+    finally:
+        # Cleanup, also when the loop dies on an error, so buffered rows reach the disk
+        writer.stop()
+        web_server.stop()
 
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description='Read data from MAX31855 sensors', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-w', '--web_output_file', default='/dev/shm/current_temp.html', help='Html output file')
-    parser.add_argument('-i', '--interval', default=1, help='Seconds at which to update the web_output_file')
+    parser.add_argument('-i', '--interval', type=float, default=1, help='Seconds at which to read the sensors and update the web_output_file')
     parser.add_argument('-p', '--web_server_port', default=8080, type=int, help='Web server port for displaying web_output_file')
     parser.add_argument('-v', '--verbose', action='store_true', help='Print each data point to stdout')
     parser.add_argument('-o', '--output_file_pattern', default='%Y%m%d-temps.tsv', help='Output file name based on date')
     parser.add_argument('-l', '--log_interval', type=int, default=1, help='Interval to log, in integer minutes')
     parser.add_argument('-s', '--output_separator', default='\t', help='Separator for output file(s)')
+    parser.add_argument('-f', '--flush_interval', type=int, default=5, help='Interval to flush output file(s) to disk, in integer minutes')
     group = parser.add_argument_group('short interval logging')
     group.add_argument('--log_short_interval', action='store_true', help='Additional log at shorter interval')
     group.add_argument('--short_output_file_pattern', default='/dev/shm/%Y%m%d-short_interval.tsv', help='File to write shorter intervales to')
@@ -2,43 +2,61 @@
 import os
 import sys
 import datetime
+import time
+import threading
 from sys import stderr
-from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    # python2.7
+    import Queue as queue
 import isp2_serial 
 
+# Interval bookkeeping uses a clock that cannot jump. python2.7 has no
+# time.monotonic, so fall back to time.time there.
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Format of the timestamp column in the output files
+TIMESTAMP_FORMAT = '%H:%M:%S'
+
 
 class Tc4DataWriter(object):
     """Write data to disk, and manage file rollover and cleanup.
     """
+    # Format of the hours column, hours since the file was started
+    hours_format = '%06.3f'
 
-    def __init__(self, filename_format='%Y%m%d-tc4.tsv', output_directory='', separator='/t'):
+    def __init__(self, filename_format='%Y%m%d-tc4.tsv', output_directory='', separator='\t'):
         self.filename_format = filename_format
-        self.output_directory = output_directory
+        self.output_directory = output_directory or ''
         self.separator = separator
-        self.current_file = None
-        self.current_file_time = None
+        self.output_file = None
+        self.output_file_time = None
+        self.row_format = None
 
-    def get_output_file(self, timestamp, header):
+    def get_output_file(self, timestamp, header_line):
         """Create or open the output file.
 
         If a new file is being created, add a header line.
         """
-        filename = os.path.join(self.output_directory, data_dict['timestamp'].strftime(self.filename_format))
-        header_line = self.separator.join(data_dict.keys())
-        if os.path.exists(filename) and not os.stat(filename).st_size == 0:
+        if self.output_file:
+            self.output_file.close()
+        filename = os.path.join(self.output_directory, timestamp.strftime(self.filename_format))
+        header = header_line + '\n'
+        # One open serves both to check the header and to append
+        self.output_file = open(filename, 'a+', 1) # line buffered
+        if os.fstat(self.output_file.fileno()).st_size != 0:
             # Check for a header line
-            f_check = open(filename) # read only
-            if f_check.readline().strip() == header_line:
+            self.output_file.seek(0)
+            if self.output_file.read(len(header)) == header:
                 # Headers match, we're good to go
-                f_check.close()
-                self.current_file = open(filename, 'a', 1) # line buffered
+                self.output_file.seek(0, os.SEEK_END)
             else:
-                stderr.write('File %s has unexpected header line' % filename)
+                stderr.write('File %s has unexpected header line\n' % filename)
                 sys.exit(1)
         else:
-            # Is safe to overwrite an empty file
-            self.current_file = open(filename, 'w', 1)  # line buffered
-            self.current_file.write(header_line + '\n')
+            # Is safe to write to an empty file
+            self.output_file.write(header)
         self.output_file_time = timestamp
 
     def rollover(self, timestamp):
@@ -46,55 +64,92 @@ class Tc4DataWriter(object):
         """
         return self.output_file_time.date() != timestamp.date()
 
-    def write(self, timestamp, data_dict):
+    def write(self, timestamp, values):
+        """Write one line of channel values.
+        """
         if not self.output_file or self.rollover(timestamp):
-            self.get_output_file(timestamp, self.assemble_line(timestamp, data_dict, header=True))
-        self.output_file.write(self.assemble_line(timestamp, data_dict))
+            self.get_output_file(timestamp, self.assemble_header(len(values)))
+            self.row_format = self.assemble_row_format(len(values))
+        self.output_file.write(self.assemble_line(timestamp, values))
+
+    def assemble_header(self, n_channels):
+        '''Header line for a file holding n_channels channels.
+        '''
+        return self.separator.join(['timestamp', 'hours'] + ['chan %i' % (i+1) for i in range(n_channels)])
 
-    def assemble_line(self, timestamp, data_dict, header=False):
+    def assemble_row_format(self, n_channels):
+        '''Format string for one line of n_channels channels, built once per file.
+        '''
+        separator = self.separator.replace('%', '%%')
+        return separator.join(['%s', self.hours_format] + ['%s'] * n_channels) + '\n'
+
+    def assemble_line(self, timestamp, values):
         '''Do the data cruching here.
         '''
-        line_elements = []
-        if header:
-            line_elements.append('timestamp')
-            line_elements.append('hours')
-        else:
-            line_elements.append(timestamp.strftime('%H:%M:%S'))
-            line_elements.append(format((timestamp-self.output_file_time).total_seconds()/3600.0, '06.3f'))
-        if header:
-            line_elements += [str(x) for x in data_dict.keys()]
-        else:
-            line_elements += [str(x) for x in data_dict.values()]
-        return self.separator.join(line_elements) + '\n'
+        hours = (timestamp-self.output_file_time).total_seconds()/3600.0
+        return self.row_format % ((timestamp.strftime(TIMESTAMP_FORMAT), hours) + tuple(values))
 
 
 class ShortIntervalDataWriter(Tc4DataWriter):
     '''Short interval files have a slightly different data format.
     '''
+    hours_format = '%07.4f'
 
     def __init__(self, filename_format='%Y%m%d-short_interval_tc4.tsv', *args, **kwargs):
         Tc4DataWriter.__init__(self, filename_format=filename_format, *args, **kwargs)
 
-    def rollover(self, timestamp):
-        """Check if this data needs to go into a new file.
+
+class WriterThread(threading.Thread):
+    """Run the data writers on a background thread.
+
+    Only the kernel buffers the serial port, so main() queues its lines here
+    rather than blocking on the disk while packets keep arriving.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue.Queue(maxsize=1024)
+        self.error = None # Raised again on the main thread
+
+    def raise_error(self):
+        """Re-raise a failure from the writer thread, such as the SystemExit
+        from a mismatched header, so that it stops main() as well.
         """
-        return self.output_file_time.date() != timestamp.date()
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def write(self, writer, timestamp, values):
+        """Queue a call to writer.write(timestamp, values).
+        """
+        self.raise_error()
+        if not self.is_alive():
+            raise RuntimeError('Writer thread has stopped')
+        self.queue.put((writer, timestamp, values))
+
+    def stop(self):
+        """Write out everything queued so far.
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        self.raise_error()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Keep emptying the queue, so main() never blocks on it
+                continue
+            writer, timestamp, values = item
+            try:
+                writer.write(timestamp, values)
+            except BaseException as e:
+                self.error = e
 
-    def assemble_line(self, timestamp, data_dict, header=False):
-        '''Do the data cruching here.
-        '''
-        line_elements = []
-        if header:
-            line_elements.append('timestamp')
-            line_elements.append('hours')
-        else:
-            line_elements.append(timestamp.strftime('%H:%M:%S'))
-            line_elements.append(format((timestamp-self.output_file_time).total_seconds()/3600.0, '07.4f'))
-        if header:
-            line_elements += [str(x) for x in data_dict.keys()]
-        else:
-            line_elements += [str(x) for x in data_dict.values()]
-        return self.separator.join(line_elements) + '\n'
 
 def main(device, output_directory=None, output_separator='\t', interval=1,
          log_short_interval=False, short_output_directory='/dev/shm', short_interval=60, verbose=False):
@@ -104,72 +159,89 @@ def main(device, output_directory=None, output_separator='\t', interval=1,
     # Setup
     output_file =  Tc4DataWriter(output_directory=output_directory, separator=output_separator)
     short_output_file = ShortIntervalDataWriter(output_directory=short_output_directory, separator=output_separator)
+    writer_thread = WriterThread()
+    writer_thread.start()
 
-    interval = datetime.timedelta(minutes=interval)
-    short_interval = datetime.timedelta(seconds=short_interval)
+    interval = interval * 60.0 # seconds
 
     # Main function
+    # Wall clock times label the output rows, monotonic deadlines end the intervals
     interval_start_time = None
+    interval_deadline = None
     short_interval_start_time = None
+    short_interval_deadline = None
     averaged_data = None
     short_interval_averaged_data = None
 
     print('About to connect to serial device %s' % device)
-    with isp2_serial.Isp2Serial(device) as ser:
-        while True:
-            try:
-                p = ser.read_packet()
-                if p.is_sensor_data:
-                    # Note the time - this is a new entry
-                    now = datetime.datetime.now()
-
-                    # Parse the packet into a dictionary. Assume only a TC-4
-                    aux_data = [p.aux_word2aux_channel(word) for word in p.data]
-                    if verbose:
-                        print(now.isoformat() + ' ' + ', '.join([str(x) for x in aux_data]))
-
-                    if not interval_start_time:
-                        interval_start_time = now
-                    if not short_interval_start_time:
-                        short_interval_start_time = now
-
-                    if now - interval_start_time > interval:
-                        # Write out old data
-                        data_dict = OrderedDict([('chan %i' % (i+1), str(avg)) for i, avg in enumerate(averaged_data)])
-                        output_file.write(interval_start_time, data_dict)
-                        # Set up for next loop
-                        interval_start_time = now
-                        averaged_data = aux_data
-                        n_in_average = 1
-                    else:
-                        # Update the running average
-                        if not averaged_data:
-                            # This should only happen the first time through the loop
-                            averaged_data = aux_data
-                            n_in_average = 1
-                        else:
-                            averaged_data = [avg + (new - avg)/n_in_average  for avg, new in zip(averaged_data, aux_data)]
+    try:
+        with isp2_serial.Isp2Serial(device) as ser:
+            while True:
+                try:
+                    p = ser.read_packet()
+                    if p.is_sensor_data:
+                        # Note the time - this is a new entry
+                        # The wall clock is only read when it is needed for output
+                        mono_now = monotonic()
+
+                        # Parse the packet into a dictionary. Assume only a TC-4
+                        aux_data = p.aux_channels()
+                        if verbose:
+                            print(datetime.datetime.now().isoformat() + ' ' + ', '.join(map(str, aux_data)))
+
+                        if not interval_start_time:
+                            interval_start_time = datetime.datetime.now()
+                            interval_deadline = mono_now + interval
+                        if not short_interval_start_time:
+                            short_interval_start_time = datetime.datetime.now()
+                            short_interval_deadline = mono_now + short_interval
 
-                    if log_short_interval:
-                        if now - short_interval_start_time > short_interval:
+                        if mono_now > interval_deadline:
                             # Write out old data
-                            data_dict = OrderedDict([('chan %i' % (i+1), str(avg)) for i, avg in enumerate(short_interval_averaged_data)])
-                            short_output_file.write(short_interval_start_time, data_dict)
+                            writer_thread.write(output_file, interval_start_time, averaged_data)
                             # Set up for next loop
-                            short_interval_start_time = now
-                            short_interval_averaged_data = aux_data
-                            n_in_short_interval_average = 1
+                            interval_start_time = datetime.datetime.now()
+                            interval_deadline = mono_now + interval
+                            averaged_data = [float(new) for new in aux_data]
+                            n_in_average = 1
                         else:
                             # Update the running average
-                            if not short_interval_averaged_data:
+                            if not averaged_data:
                                 # This should only happen the first time through the loop
-                                short_interval_averaged_data = aux_data
+                                averaged_data = [float(new) for new in aux_data]
+                                n_in_average = 1
+                            else:
+                                # In place, to avoid building a new list for every packet
+                                n_in_average += 1
+                                for i, new in enumerate(aux_data):
+                                    averaged_data[i] += (new - averaged_data[i]) / n_in_average
+
+                        if log_short_interval:
+                            if mono_now > short_interval_deadline:
+                                # Write out old data
+                                writer_thread.write(short_output_file, short_interval_start_time, short_interval_averaged_data)
+                                # Set up for next loop
+                                short_interval_start_time = datetime.datetime.now()
+                                short_interval_deadline = mono_now + short_interval
+                                short_interval_averaged_data = [float(new) for new in aux_data]
                                 short_interval_n_in_average = 1
                             else:
-                                short_interval_averaged_data = [avg + (new - avg)/short_interval_n_in_average  for avg, new in zip(short_interval_averaged_data, aux_data)]
+                                # Update the running average
+                                if not short_interval_averaged_data:
+                                    # This should only happen the first time through the loop
+                                    short_interval_averaged_data = [float(new) for new in aux_data]
+                                    short_interval_n_in_average = 1
+                                else:
+                                    # In place, to avoid building a new list for every packet
+                                    short_interval_n_in_average += 1
+                                    for i, new in enumerate(aux_data):
+                                        short_interval_averaged_data[i] += (new - short_interval_averaged_data[i]) / short_interval_n_in_average
 
-            except KeyboardInterrupt:
-                break
+                except KeyboardInterrupt:
+                    break
+    finally:
+        # Also on errors, so the rows already queued reach the disk
+        writer_thread.stop()
 
 
 if __name__ == '__main__':
@@ -12,6 +12,9 @@ import serial
 
 import packet
 
+# Commands are sent as a single big endian unsigned short word
+_COMMAND = struct.Struct('>H')
+
 
 class Isp2Serial(serial.Serial):
     def __init__(self, device):
@@ -63,27 +66,27 @@ class Isp2Serial(serial.Serial):
         '''
         if len(device_name) > 8:
             raise Exception('Device name cannot be longer than 8 characters')
-        self.send(struct.pack('>H', 0xCC) + device_name.ljust(8, '0'))
+        self.send(_COMMAND.pack(0xCC) + device_name.ljust(8, '0'))
 
     def unlisten(self):
         '''Stop listening.
 
         The device that was listening will send a reply packet that contains the command.
         '''
-        self.send(struct.pack('>H', 0xEC))
+        self.send(_COMMAND.pack(0xEC))
 
     def namelist(self):
         '''Request a list of device names.
 
         Response will contain a list of names.
         '''
-        self.send(struct.pack('>H', 0xCE))
+        self.send(_COMMAND.pack(0xCE))
 
     def typelist(self):
         '''Request a list of device types.
 
         Response will contain a list of types, 8 bytes per device.
         '''
-        self.send(struct.pack('>H', 0xCE))
+        self.send(_COMMAND.pack(0xCE))
 
 
@@ -6,6 +6,27 @@ http://www.innovatemotorsports.com/support/downloads/Seriallog-2.pdf
 """
 
 import struct
+from functools import reduce
+from operator import or_
+
+# A single ISP2 word, for the header
+# ISP2 words are big endian, indicated by ">"
+# ISP2 words are unsigned short, indicated by "H"
+_WORD = struct.Struct(">H")
+# Compiled structs for whole data payloads, keyed by number of words
+_WORD_STRUCTS = {}
+# Bits 13-8 of an aux word, shifted down by one, for each possible high byte
+_AUX_HIGH = tuple((high & 0b00111111) << 7 for high in range(256))
+
+# Bitmasks used when decoding, as module globals so the methods below skip
+# the attribute lookup through the class. InnovatePacket exposes them too.
+_START_MARKER_MASK = 0b1000000000000000
+# In a header word, bits 13, 9, and 7 will be 1.
+_HEADER_MASK             = _START_MARKER_MASK | 0b0010001010000000
+_RECORDING_TO_FLASH_MASK = 0b0100000000000000 # In header. 1 is is recording.
+_SENSOR_DATA_MASK        = 0b0001000000000000 # In header. 1 if data, 0 if reply to command.
+_CAN_LOG_MASK            = 0b0000100000000000 # In header. 1 if originating device can do internal logging.
+_AUX_CHANNEL_LOW_MASK    = 0b1100000010000000 # The other bits are data from the sensor
 
 
 class InnovatePacket(object):
@@ -13,15 +34,18 @@ class InnovatePacket(object):
 
     ISP2 packets are composed of 16 bit words.
     """
+    # Packets are created for every read, so skip the per-instance __dict__
+    __slots__ = ('_header', '_data', 'devices', 'packet_length',
+                 'is_recording_to_flash', 'is_sensor_data', 'can_log')
+
     # Define some bitmasks
-    START_MARKER_MASK = 0b1000000000000000
-    # In a header word, bits 13, 9, and 7 will be 1.
-    HEADER_MASK             = START_MARKER_MASK | 0b0010001010000000
-    RECORDING_TO_FLASH_MASK = 0b0100000000000000 # In header. 1 is is recording.
-    SENSOR_DATA_MASK        = 0b0001000000000000 # In header. 1 if data, 0 if reply to command.
-    CAN_LOG_MASK            = 0b0000100000000000 # In header. 1 if originating device can do internal logging.
-
-    AUX_CHANNEL_LOW_MASK    = 0b1100000010000000 # The other bits are data from the sensor
+    START_MARKER_MASK       = _START_MARKER_MASK
+    HEADER_MASK             = _HEADER_MASK
+    RECORDING_TO_FLASH_MASK = _RECORDING_TO_FLASH_MASK
+    SENSOR_DATA_MASK        = _SENSOR_DATA_MASK
+    CAN_LOG_MASK            = _CAN_LOG_MASK
+
+    AUX_CHANNEL_LOW_MASK    = _AUX_CHANNEL_LOW_MASK
     LM1_HIGH_MASK           = START_MARKER_MASK
     LM1_LOW_MASK            = 0b0010001010000000 # First word of LM-1
     LC1_HIGH_MASK           = 0b0100001000000000 # First of two words from an LC-1, bits always high
@@ -42,10 +66,16 @@ class InnovatePacket(object):
         if bytestring is None:
             return None
         # Each word is two bytes long
-        n_words = len(bytestring)/2
-        # ISP2 words are big endian, indicated by ">"
-        # ISP2 words are unsigned short, indicated by "H"
-        return struct.unpack(">%dH" % n_words, bytestring)
+        if len(bytestring) & 1:
+            raise Exception('Data must be a whole number of words.')
+        n_words = len(bytestring) >> 1
+        try:
+            words = _WORD_STRUCTS[n_words]
+        except KeyError:
+            # ISP2 words are big endian, indicated by ">"
+            # ISP2 words are unsigned short, indicated by "H"
+            words = _WORD_STRUCTS[n_words] = struct.Struct(">%dH" % n_words)
+        return words.unpack(bytestring)
 
     @property
     def header(self):
@@ -55,53 +85,34 @@ class InnovatePacket(object):
     def header(self, header):
         """Input header as a bytestring.
         """
-        header = self._to_words(header)
         if header:
-            if len(header) != 1:
+            # The header is always a single word, so skip the general _to_words
+            if len(header) != 2:
                 raise Exception('Header must be exactly one word long.')
-            header = header[0]
-            if not header & self.HEADER_MASK == self.HEADER_MASK:
+            header = _WORD.unpack(header)[0]
+            if not header & _HEADER_MASK == _HEADER_MASK:
                 raise Exception('Invalid header %s' % header)
+        else:
+            header = None
         self._header = header
-
-    ## Data stored in the header ##
-
-    @property
-    def packet_length(self):
-        """Get the packet length from the header.
-
-        Packet length is the number of data words after the header.
-        Note that each word is 2 bytes long.
-        """
-        if self._header:
-            # Packet length is encoded in bit 8 and bits 6-0
-            # First, get bits 6-0
-            packet_length = self._header & 0b0000000001111111
-            # Bit 8 is the 7th (zero-indexed) bit in the length
-            if self._header & 0b0000000100000000:
-                packet_length += 0b10000000 # 128
-            return packet_length
-
-    @property
-    def is_recording_to_flash(self):
-        """Return boolean indicating whether the data is being recorded to flash.
-        """
-        if self._header:
-            return self.header & self.RECORDING_TO_FLASH_MASK == self.RECORDING_TO_FLASH_MASK
-
-    @property
-    def is_sensor_data(self):
-        """Return True if the packet contains sensor data, False if it is a reply to a command.
-        """
-        if self.header:
-            return self.header & self.SENSOR_DATA_MASK == self.SENSOR_DATA_MASK
-
-    @property
-    def can_log(self):
-        """Return boolean indicating whether the originating device can do internal logging.
-        """
-        if self._header:
-            return self.header & self.CAN_LOG_MASK == self.CAN_LOG_MASK
+        # Decode the header fields once here, into plain attributes
+        if header:
+            # Packet length is the number of data words after the header.
+            # Note that each word is 2 bytes long.
+            # It is encoded in bit 8 and bits 6-0.
+            # Bit 8 is the 7th (zero-indexed) bit in the length.
+            self.packet_length = (header & 0b0000000001111111) | ((header & 0b0000000100000000) >> 1)
+            # True if the data is being recorded to flash
+            self.is_recording_to_flash = header & _RECORDING_TO_FLASH_MASK == _RECORDING_TO_FLASH_MASK
+            # True if the packet contains sensor data, False if it is a reply to a command
+            self.is_sensor_data = header & _SENSOR_DATA_MASK == _SENSOR_DATA_MASK
+            # True if the originating device can do internal logging
+            self.can_log = header & _CAN_LOG_MASK == _CAN_LOG_MASK
+        else:
+            self.packet_length = None
+            self.is_recording_to_flash = None
+            self.is_sensor_data = None
+            self.can_log = None
 
     ## The data ##
 
@@ -113,10 +124,12 @@ class InnovatePacket(object):
     def data(self, data):
         """Input data as a bytestring.
         """
+        packet_length = self.packet_length
         data = self._to_words(data)
-        if not data and self.packet_length:
-            raise Exception('No data in packet, expected %i' % self.packet_length)
-        if self._header and len(data) != self.packet_length:
+        if not data:
+            if packet_length:
+                raise Exception('No data in packet, expected %i' % packet_length)
+        elif self._header and len(data) != packet_length:
             raise Exception('Packet length does not match specification from header')
         self._data = data
 
@@ -124,13 +137,24 @@ class InnovatePacket(object):
         """Strip unused bits from an aux channel word.
         """
         # Confirm that this is an aux channel word
-        if not word & self.AUX_CHANNEL_LOW_MASK == 0:
+        if not word & _AUX_CHANNEL_LOW_MASK == 0:
             raise Exception('Not an aux channel word')
         # The MSB of each (8-bit) byte in Aux words is zero
-        # First, get bits 6-0
-        aux_channel = word & 0b0000000001111111
-        # Now get bits 13-8 and shift them by one
-        aux_channel += (word & 0b0011111100000000) >> 1
-        return aux_channel
+        # Bits 6-0 are used as is, bits 13-8 come shifted from the lookup table
+        return _AUX_HIGH[word >> 8] | (word & 0b0000000001111111)
+
+    def aux_channels(self):
+        """Strip unused bits from every data word, treating them all as aux channel words.
+
+        Same as calling aux_word2aux_channel on each word, without a method
+        call per word.
+        """
+        if not self._data:
+            return []
+        # Confirm that these are all aux channel words, with a single test
+        # on all the words or-ed together
+        if reduce(or_, self._data) & _AUX_CHANNEL_LOW_MASK:
+            raise Exception('Not an aux channel word')
+        return [_AUX_HIGH[word >> 8] | (word & 0b0000000001111111) for word in self._data]
 
 
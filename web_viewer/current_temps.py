@@ -1,15 +1,34 @@
 #!/usr/bin/env python
 
-import SimpleHTTPServer
-import SocketServer
+from __future__ import print_function
+import os
+
+try:
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python2.7
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Serve each request on its own thread, so one slow client can't stall the rest.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
 
 
 def main(port, directory):
-    Handler = SimpleHTTPServer.SimpleHTTPRequestHandler
+    # SimpleHTTPRequestHandler serves the working directory
+    # (python2.7 has no directory argument for the handler)
+    os.chdir(directory)
+    Handler = SimpleHTTPRequestHandler
 
-    httpd = SocketServer.TCPServer(("", port), Handler)
+    httpd = ThreadingHTTPServer(("", port), Handler)
 
-    print "serving at port", PORT
+    print("serving at port", port)
     httpd.serve_forever()
 
 